@@ -13,8 +13,13 @@ import psycopg2
 from psycopg2.extras import Json
 from rq import Queue
 from redis import Redis
+from redis.exceptions import RedisError
+from cryptography.fernet import Fernet, InvalidToken
 import time
 import re
+import json
+import base64
+import hashlib
 from io import BytesIO
 import logging
 
@@ -23,7 +28,8 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-app.secret_key = os.environ.get('SESSION_SECRET', secrets.token_hex(16))
+# Required: it also keys the encryption of cached Telegram sessions shared by every web process
+app.secret_key = os.environ['SESSION_SECRET']
 
 # Database connection
 def get_db_connection():
@@ -93,6 +99,13 @@ def init_db():
         INSERT INTO reply_state (id, monitoring, target_recipient, target_groups, found_matches, group_numbers, processed_messages, replies_received, duplicate_replies, sending_start_times, duplicate_time_window, number_timestamps, last_auto_reply, group_numbers_ttl)
         VALUES (1, FALSE, NULL, '{}', '{}', '{}', '{}', '{}', '{}', '{}', 1800, '{}', '{}', '{}')
         ON CONFLICT (id) DO NOTHING;
+
+        CREATE TABLE IF NOT EXISTS sent_ledger (
+            job_key TEXT PRIMARY KEY,
+            bitmap BYTEA,
+            updated_at FLOAT
+        );
+        CREATE INDEX IF NOT EXISTS sent_ledger_updated_at_idx ON sent_ledger (updated_at);
     """)
     conn.commit()
     cursor.close()
@@ -108,6 +121,130 @@ redis_conn = Redis(
 )
 queue = Queue(connection=redis_conn)
 
+# Write-through cache of auth_state in Redis; session strings are encrypted with SESSION_SECRET
+AUTH_STATE_CACHE_KEY = 'auth_state:1'
+AUTH_STATE_VERSION_KEY = 'auth_state:1:version'
+AUTH_STATE_CACHE_TTL = int(os.environ.get('AUTH_STATE_CACHE_TTL', 3600))
+AUTH_STATE_FIELDS = ('phone_number', 'code_requested', 'is_authenticated', 'phone_code_hash', 'session_string', 'monitoring_session_string')
+AUTH_STATE_ENCRYPTED_FIELDS = ('session_string', 'monitoring_session_string')
+auth_state_cipher = Fernet(base64.urlsafe_b64encode(hashlib.sha256(app.secret_key.encode('utf-8')).digest()))
+
+# A refill only lands if no save_auth_state has bumped the version since the reader fetched it
+fill_auth_state_cache = redis_conn.register_script("""
+if (redis.call('GET', KEYS[1]) or '0') == ARGV[1] then
+    redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+    return 1
+end
+return 0
+""")
+
+def get_auth_state_version():
+    try:
+        version = redis_conn.get(AUTH_STATE_VERSION_KEY)
+    except RedisError as e:
+        logger.warning(f"Failed to read auth state cache version: {e}")
+        return None
+    return version.decode('ascii') if version is not None else '0'
+
+def cache_auth_state(auth_state, version):
+    cached = dict(auth_state)
+    for field in AUTH_STATE_ENCRYPTED_FIELDS:
+        if cached[field] is not None:
+            cached[field] = auth_state_cipher.encrypt(cached[field].encode('utf-8')).decode('ascii')
+    try:
+        fill_auth_state_cache(
+            keys=[AUTH_STATE_VERSION_KEY, AUTH_STATE_CACHE_KEY],
+            args=[version, json.dumps(cached), AUTH_STATE_CACHE_TTL]
+        )
+    except RedisError as e:
+        logger.warning(f"Failed to cache auth state: {e}")
+
+def invalidate_auth_state_cache():
+    try:
+        pipe = redis_conn.pipeline()
+        pipe.incr(AUTH_STATE_VERSION_KEY)
+        pipe.delete(AUTH_STATE_CACHE_KEY)
+        pipe.execute()
+    except RedisError as e:
+        logger.error(f"Failed to invalidate cached auth state: {e}")
+
+def load_cached_auth_state():
+    try:
+        cached = redis_conn.get(AUTH_STATE_CACHE_KEY)
+    except RedisError as e:
+        logger.warning(f"Failed to read cached auth state: {e}")
+        return None
+    if cached is None:
+        return None
+    try:
+        cached = json.loads(cached)
+        auth_state = {field: cached[field] for field in AUTH_STATE_FIELDS}
+        for field in AUTH_STATE_ENCRYPTED_FIELDS:
+            if auth_state[field] is not None:
+                auth_state[field] = auth_state_cipher.decrypt(auth_state[field].encode('ascii')).decode('utf-8')
+    except (ValueError, KeyError, TypeError, AttributeError, InvalidToken):
+        # Malformed or written under a different secret; fall back to the database
+        return None
+    return auth_state
+
+def load_auth_state():
+    auth_state = load_cached_auth_state()
+    if auth_state is not None:
+        return auth_state
+    # Read the version before the database so a save that commits in between rejects this refill
+    version = get_auth_state_version()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT phone_number, code_requested, is_authenticated, phone_code_hash, session_string, monitoring_session_string FROM auth_state WHERE id = 1")
+    row = cursor.fetchone()
+    cursor.close()
+    conn.close()
+    if row:
+        auth_state = dict(zip(AUTH_STATE_FIELDS, row))
+    else:
+        auth_state = {
+            'phone_number': None,
+            'code_requested': False,
+            'is_authenticated': False,
+            'phone_code_hash': None,
+            'session_string': None,
+            'monitoring_session_string': None
+        }
+    if version is not None:
+        cache_auth_state(auth_state, version)
+    return auth_state
+
+def save_auth_state(auth_state):
+    # Drop the cached copy first so a failed write can never leave a stale session readable
+    invalidate_auth_state_cache()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO auth_state (
+            id, phone_number, code_requested, is_authenticated, phone_code_hash, session_string, monitoring_session_string
+        ) VALUES (1, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (id) DO UPDATE SET
+            phone_number = EXCLUDED.phone_number,
+            code_requested = EXCLUDED.code_requested,
+            is_authenticated = EXCLUDED.is_authenticated,
+            phone_code_hash = EXCLUDED.phone_code_hash,
+            session_string = EXCLUDED.session_string,
+            monitoring_session_string = EXCLUDED.monitoring_session_string
+    """, (
+        auth_state['phone_number'],
+        auth_state['code_requested'],
+        auth_state['is_authenticated'],
+        auth_state['phone_code_hash'],
+        auth_state['session_string'],
+        auth_state['monitoring_session_string']
+    ))
+    conn.commit()
+    cursor.close()
+    conn.close()
+    # Bump the version again rather than re-caching: any refill that read the old row is now rejected,
+    # and a concurrent writer's older state can never be written over this one
+    invalidate_auth_state_cache()
+
 # Telegram API credentials
 API_ID = int(os.environ.get('25509235', 0)) if os.environ.get('TELEGRAM_API_ID') else None
 API_HASH = os.environ.get('d3629ab967e8ecac197831192aa36d65', '')
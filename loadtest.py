@@ -0,0 +1,321 @@
+import os
+import sys
+import time
+import json
+import math
+import ipaddress
+import urllib.parse
+import random
+import argparse
+import threading
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+# Load-test harness for the web tier.
+#
+# Run the Flask app against local Postgres and Redis stand-ins (point DB_* and REDIS_* at them,
+# and leave the RQ worker stopped so enqueued jobs are never sent to Telegram), then e.g.:
+#
+#   python loadtest.py --base-url http://127.0.0.1:5000 --concurrency 20 --duration 60
+#
+# The same DB_* / REDIS_* environment is used to sample connection counts while the test runs,
+# and to delete every send job the upload scenario enqueued once it finishes (unless --keep-jobs).
+# Only loopback targets are accepted without --allow-remote, and the monitor scenario, which
+# drives the Telegram-facing cron entry point, only runs when named in --mix.
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIX = 'upload=1,status=8,stop=1,dashboard=2'
+
+def build_multipart(fields, files, rng):
+    boundary = f'{rng.getrandbits(128):032x}'
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8')
+        )
+    for name, (filename, data, content_type) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'.encode('utf-8') + data + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+def build_upload_request(args, rng):
+    rows = '\n'.join(f'+1555{rng.randint(0, 9999999):07d}' for _ in range(args.upload_rows))
+    if args.upload_kind == 'manual':
+        fields = {'manual_data': rows, 'recipient': args.recipient, 'send_mode': 'columns'}
+        files = {}
+    else:
+        fields = {'recipient': args.recipient, 'send_mode': 'columns'}
+        files = {'file': ('loadtest.csv', ('number\n' + rows).encode('utf-8'), 'text/csv')}
+    body, content_type = build_multipart(fields, files, rng)
+    return 'POST', '/upload', body, {'Content-Type': content_type, 'X-Requested-With': 'XMLHttpRequest'}
+
+SCENARIOS = {
+    'upload': build_upload_request,
+    'status': lambda args, rng: ('GET', '/sending_status', None, {}),
+    'stop': lambda args, rng: ('POST', '/stop', b'{}', {'Content-Type': 'application/json'}),
+    'dashboard': lambda args, rng: ('GET', '/', None, {}),
+    'monitor': lambda args, rng: ('GET', '/cron/monitor', None, {}),
+}
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Unknown scenario '{name}', expected one of {', '.join(SCENARIOS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank method
+    rank = math.ceil(pct / 100 * len(sorted_values)) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+def is_loopback_url(url):
+    host = urllib.parse.urlsplit(url).hostname or ''
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def open_redis():
+    from redis import Redis
+    return Redis(
+        host=os.environ.get('REDIS_HOST', 'localhost'),
+        port=int(os.environ.get('REDIS_PORT', 6379)),
+        password=os.environ.get('REDIS_PASSWORD', None)
+    )
+
+def open_job_queue():
+    from rq import Queue
+    return Queue(connection=open_redis())
+
+def remove_new_jobs(queue, existing_ids):
+    # Only jobs enqueued during this run are deleted; anything already queued is left alone
+    new_ids = [job_id for job_id in queue.get_job_ids() if job_id not in existing_ids]
+    for job_id in new_ids:
+        job = queue.fetch_job(job_id)
+        if job is not None:
+            job.delete()
+    return len(new_ids)
+
+def count_postgres_connections():
+    import psycopg2
+    conn = psycopg2.connect(
+        dbname=os.environ['DB_NAME'],
+        user=os.environ['DB_USER'],
+        password=os.environ['DB_PASSWORD'],
+        host=os.environ['DB_HOST'],
+        port=os.environ['DB_PORT']
+    )
+    try:
+        cursor = conn.cursor()
+        # Exclude this sampling connection itself
+        cursor.execute("SELECT count(*) - 1 FROM pg_stat_activity WHERE datname = current_database()")
+        count = cursor.fetchone()[0]
+        cursor.close()
+        return count
+    finally:
+        conn.close()
+
+def count_redis_connections(redis_conn):
+    # Exclude this sampling connection itself
+    return redis_conn.info('clients')['connected_clients'] - 1
+
+def sample_connections(stop_event, interval, samples):
+    redis_conn = None
+    try:
+        redis_conn = open_redis()
+    except ImportError:
+        logger.warning("redis package not installed, skipping Redis connection sampling")
+    while not stop_event.is_set():
+        if 'DB_HOST' in os.environ:
+            try:
+                samples['postgres'].append(count_postgres_connections())
+            except Exception as e:
+                logger.warning(f"Postgres connection sampling failed: {e}")
+        if redis_conn is not None:
+            try:
+                samples['redis'].append(count_redis_connections(redis_conn))
+            except Exception as e:
+                logger.warning(f"Redis connection sampling failed: {e}")
+        stop_event.wait(interval)
+
+def send_request(args, scenario, rng):
+    method, path, body, headers = SCENARIOS[scenario](args, rng)
+    req = urllib.request.Request(args.base_url.rstrip('/') + path, data=body, headers=headers, method=method)
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=args.timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except Exception as e:
+        logger.debug(f"{method} {path} failed: {e}")
+        status = None
+    return scenario, status, time.perf_counter() - start
+
+def run_load_test(args, job_queue=None):
+    scenarios, scenario_weights = list(args.mix), list(args.mix.values())
+    results = {name: {'latencies': [], 'errors': 0, 'statuses': {}} for name in scenarios}
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration if args.duration else None
+    remaining = [args.requests]
+    # Scenario picks and per-request payload seeds come from one RNG under the lock, so a seed fixes the sequence
+    sequence_rng = random.Random(args.seed)
+    aborted = threading.Event()
+
+    def next_scenario():
+        with lock:
+            if aborted.is_set():
+                return None, None
+            if deadline is not None:
+                if time.monotonic() >= deadline:
+                    return None, None
+            elif remaining[0] <= 0:
+                return None, None
+            else:
+                remaining[0] -= 1
+            scenario = sequence_rng.choices(scenarios, scenario_weights)[0]
+            return scenario, random.Random(sequence_rng.getrandbits(64))
+
+    def user_loop():
+        try:
+            while True:
+                scenario, request_rng = next_scenario()
+                if scenario is None:
+                    return
+                name, status, elapsed = send_request(args, scenario, request_rng)
+                with lock:
+                    result = results[name]
+                    result['latencies'].append(elapsed)
+                    result['statuses'][str(status)] = result['statuses'].get(str(status), 0) + 1
+                    if status is None or status >= 500:
+                        result['errors'] += 1
+        except BaseException:
+            aborted.set()
+            raise
+
+    samples = {'postgres': [], 'redis': []}
+    stop_event = threading.Event()
+    sampler = threading.Thread(target=sample_connections, args=(stop_event, args.sample_interval, samples), daemon=True)
+    sampler.start()
+    existing_job_ids = set(job_queue.get_job_ids()) if job_queue is not None else None
+    jobs_removed = None
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            users = [executor.submit(user_loop) for _ in range(args.concurrency)]
+        # Re-raise the first failure from a simulated user instead of reporting a silently shrunken run
+        for user in users:
+            user.result()
+        wall_time = time.perf_counter() - started
+    finally:
+        stop_event.set()
+        sampler.join()
+        if job_queue is not None:
+            try:
+                jobs_removed = remove_new_jobs(job_queue, existing_job_ids)
+                logger.info(f"Removed {jobs_removed} send jobs enqueued by this run")
+            except Exception as e:
+                logger.error(f"Failed to remove send jobs enqueued by this run, clear the queue before starting a worker: {e}")
+    report = build_report(args, results, samples, wall_time)
+    report['jobs_removed'] = jobs_removed
+    return report
+
+def summarize(latencies, errors, wall_time):
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'throughput_rps': len(ordered) / wall_time if wall_time else 0.0,
+        'p50_ms': percentile(ordered, 50) * 1000,
+        'p95_ms': percentile(ordered, 95) * 1000,
+        'p99_ms': percentile(ordered, 99) * 1000,
+        'max_ms': (ordered[-1] * 1000) if ordered else 0.0
+    }
+
+def build_report(args, results, samples, wall_time):
+    endpoints = {}
+    all_latencies = []
+    all_errors = 0
+    for name, result in results.items():
+        endpoints[name] = summarize(result['latencies'], result['errors'], wall_time)
+        endpoints[name]['statuses'] = result['statuses']
+        all_latencies.extend(result['latencies'])
+        all_errors += result['errors']
+    connections = {}
+    for backend, values in samples.items():
+        if values:
+            connections[backend] = {'min': min(values), 'max': max(values), 'avg': sum(values) / len(values)}
+    return {
+        'base_url': args.base_url,
+        'concurrency': args.concurrency,
+        'wall_time_s': wall_time,
+        'total': summarize(all_latencies, all_errors, wall_time),
+        'endpoints': endpoints,
+        'connections': connections
+    }
+
+def print_report(report):
+    print(f"Target: {report['base_url']}  concurrency={report['concurrency']}  wall={report['wall_time_s']:.1f}s")
+    print(f"{'endpoint':<12}{'requests':>10}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    rows = list(report['endpoints'].items()) + [('TOTAL', report['total'])]
+    for name, stats in rows:
+        print(f"{name:<12}{stats['requests']:>10}{stats['errors']:>8}{stats['throughput_rps']:>10.1f}"
+              f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+    for backend, stats in report['connections'].items():
+        print(f"{backend} connections: min={stats['min']} avg={stats['avg']:.1f} max={stats['max']}")
+    if report['jobs_removed'] is not None:
+        print(f"send jobs enqueued and removed: {report['jobs_removed']}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive the Flask upload, status and monitoring endpoints under concurrent load.")
+    parser.add_argument('--base-url', default=os.environ.get('LOADTEST_BASE_URL', 'http://127.0.0.1:5000'))
+    parser.add_argument('--concurrency', type=int, default=10, help="Number of simulated dashboard users")
+    parser.add_argument('--requests', type=int, default=1000, help="Total requests to send (ignored with --duration)")
+    parser.add_argument('--duration', type=float, default=0, help="Run for this many seconds instead of a fixed request count")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help=f"Weighted scenario mix (default: {DEFAULT_MIX})")
+    parser.add_argument('--upload-rows', type=int, default=100, help="Rows per uploaded payload")
+    parser.add_argument('--upload-kind', choices=('csv', 'manual'), default='csv')
+    parser.add_argument('--recipient', default='@loadtest_sink')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--sample-interval', type=float, default=1.0, help="Seconds between connection count samples")
+    parser.add_argument('--seed', type=int, default=None, help="Random seed for a reproducible request sequence")
+    parser.add_argument('--json', dest='json_path', default=None, help="Also write the report as JSON to this path")
+    parser.add_argument('--allow-remote', action='store_true', help="Allow a non-loopback --base-url")
+    parser.add_argument('--keep-jobs', action='store_true', help="Leave the send jobs enqueued by uploads in Redis")
+    args = parser.parse_args(argv)
+    if not args.allow_remote and not is_loopback_url(args.base_url):
+        parser.error(f"refusing to load-test non-loopback {args.base_url} without --allow-remote")
+
+    job_queue = None
+    if 'upload' in args.mix and not args.keep_jobs:
+        try:
+            job_queue = open_job_queue()
+            job_queue.get_job_ids()
+        except Exception as e:
+            parser.error(f"cannot reach the RQ queue to clean up upload jobs ({e}); pass --keep-jobs to run anyway")
+
+    report = run_load_test(args, job_queue)
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 1 if report['total']['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,164 @@
+import os
+import stat
+import mmap
+import struct
+import hashlib
+from array import array
+import tempfile
+import logging
+
+logger = logging.getLogger(__name__)
+
+# On-disk cache of rendered message batches, shared by workers of the same user on the same host
+RENDER_CACHE_DIR = os.environ.get('RENDER_CACHE_DIR', os.path.join(tempfile.gettempdir(), f'teleweb_render_cache-{os.getuid()}'))
+RENDER_CACHE_MAX_BYTES = int(os.environ.get('RENDER_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# File layout: header, (count + 1) native uint64 offsets, then the UTF-8 blob of all messages
+CACHE_MAGIC = b'TWRC'
+CACHE_VERSION = 1
+HEADER = struct.Struct('=4sIQQ')
+OFFSET_SIZE = array('Q').itemsize
+CACHE_SUFFIX = '.msgs'
+
+def render_cache_key(file_data, file_ext, send_mode):
+    digest = hashlib.sha256()
+    digest.update(f"{CACHE_VERSION}:{file_ext}:{send_mode}\0".encode('utf-8'))
+    digest.update(file_data)
+    return digest.hexdigest()
+
+def _cache_path(key):
+    return os.path.join(RENDER_CACHE_DIR, key + CACHE_SUFFIX)
+
+def _is_private(st, file_type):
+    return file_type(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & (stat.S_IRWXG | stat.S_IRWXO)
+
+def _cache_dir_is_private(create=False):
+    # Cached batches are sent verbatim from the Telegram session, so only trust a directory we own that no one else can access
+    if create:
+        os.makedirs(RENDER_CACHE_DIR, mode=0o700, exist_ok=True)
+    try:
+        st = os.lstat(RENDER_CACHE_DIR)
+    except FileNotFoundError:
+        return False
+    if not _is_private(st, stat.S_ISDIR):
+        logger.warning(f"Ignoring render cache directory {RENDER_CACHE_DIR}: not a private directory owned by this user")
+        return False
+    return True
+
+class RenderedMessages:
+    # Read-only sequence view over a cache file; messages are decoded straight from the mapping on access
+    def __init__(self, fileobj):
+        self._mmap = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, count, segment = HEADER.unpack_from(self._mmap, 0)
+            blob_start = HEADER.size + (count + 1) * OFFSET_SIZE
+            if magic != CACHE_MAGIC or version != CACHE_VERSION or blob_start > len(self._mmap):
+                raise ValueError("Invalid render cache file")
+            self._view = memoryview(self._mmap)
+            self._offsets = self._view[HEADER.size:blob_start].cast('Q')
+            self._blob = self._view[blob_start:]
+            # Reject truncated or corrupted entries up front so they take the discard-and-miss path
+            offsets = self._offsets
+            if offsets[0] != 0 or offsets[count] != len(self._blob) or any(a > b for a, b in zip(offsets, offsets[1:])):
+                raise ValueError("Invalid render cache offsets")
+        except Exception:
+            self.close()
+            raise
+        self.segment = segment
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        return str(self._blob[self._offsets[index]:self._offsets[index + 1]], 'utf-8')
+
+    def close(self):
+        if self._mmap.closed:
+            return
+        for name in ('_offsets', '_blob', '_view'):
+            view = getattr(self, name, None)
+            if view is not None:
+                view.release()
+        self._mmap.close()
+
+def load_rendered_messages(key):
+    if not _cache_dir_is_private():
+        return None
+    path = _cache_path(key)
+    try:
+        with open(os.open(path, os.O_RDONLY | os.O_NOFOLLOW), 'rb') as f:
+            if not _is_private(os.fstat(f.fileno()), stat.S_ISREG):
+                raise ValueError("Render cache entry is not a private regular file")
+            rendered = RenderedMessages(f)
+        # Touch on hit so eviction drops the least recently used batches first
+        os.utime(path)
+        return rendered
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, struct.error) as e:
+        logger.warning(f"Discarding unreadable render cache entry {key}: {e}")
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+def store_rendered_messages(key, messages, segment):
+    encoded = [message.encode('utf-8') for message in messages]
+    offsets = array('Q', [0])
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+    size = HEADER.size + len(offsets) * OFFSET_SIZE + offsets[-1]
+    if size > RENDER_CACHE_MAX_BYTES:
+        return
+    try:
+        if not _cache_dir_is_private(create=True):
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=RENDER_CACHE_DIR, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(CACHE_MAGIC, CACHE_VERSION, len(encoded), segment))
+                f.write(offsets.tobytes())
+                for data in encoded:
+                    f.write(data)
+            os.replace(tmp_path, _cache_path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        evict_render_cache()
+    except OSError as e:
+        logger.warning(f"Failed to store render cache entry {key}: {e}")
+
+def evict_render_cache(max_bytes=None):
+    max_bytes = RENDER_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    total = 0
+    if not _cache_dir_is_private():
+        return
+    try:
+        with os.scandir(RENDER_CACHE_DIR) as it:
+            for entry in it:
+                if not entry.name.endswith(CACHE_SUFFIX):
+                    continue
+                try:
+                    entry_stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+                total += entry_stat.st_size
+    except FileNotFoundError:
+        return
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -1,18 +1,31 @@
 import os
 import asyncio
-import pandas as pd
 from telethon import TelegramClient
 from telethon.sessions import StringSession
 from telethon.errors import FloodWaitError
 import logging
+import hashlib
+import time
+import re
 from io import BytesIO
 import psycopg2
 from psycopg2.extras import Json
+from render_cache import render_cache_key, load_rendered_messages, store_rendered_messages
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Sent-item ledger is persisted after this many new deliveries or seconds, whichever comes first
+LEDGER_FLUSH_EVERY = int(os.environ.get('LEDGER_FLUSH_EVERY', 25))
+LEDGER_FLUSH_SECONDS = float(os.environ.get('LEDGER_FLUSH_SECONDS', 10))
+# Ledgers of interrupted jobs are forgotten once they have not been touched for this long
+LEDGER_TTL_SECONDS = float(os.environ.get('LEDGER_TTL_SECONDS', 6 * 3600))
+
+# Line boundaries recognised by str.splitlines(), plus their UTF-8 encodings for raw uploads
+LINE_BREAKS = re.compile('\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+LINE_BREAKS_UTF8 = re.compile(b'\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]')
+
 # Database connection
 def get_db_connection():
     return psycopg2.connect(
@@ -108,6 +121,76 @@ def save_sending_state(sending_state):
     cursor.close()
     conn.close()
 
+def compute_job_key(file_payload, manual_data, recipient, send_mode):
+    digest = hashlib.sha256()
+    digest.update(str(recipient).encode('utf-8') + b'\0')
+    digest.update(str(send_mode).encode('utf-8') + b'\0')
+    if file_payload:
+        digest.update(file_payload['filename'].encode('utf-8') + b'\0')
+        digest.update(file_payload['data'])
+    elif manual_data:
+        digest.update(manual_data.encode('utf-8'))
+    return digest.hexdigest()
+
+def load_sent_ledger(job_key):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM sent_ledger WHERE updated_at < %s", (time.time() - LEDGER_TTL_SECONDS,))
+    cursor.execute("SELECT bitmap FROM sent_ledger WHERE job_key = %s", (job_key,))
+    row = cursor.fetchone()
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return {
+        'job_key': job_key,
+        'bitmap': bytearray(row[0]) if row else bytearray(),
+        'pending': 0,
+        'last_flush': time.time()
+    }
+
+def save_sent_ledger(ledger):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO sent_ledger (job_key, bitmap, updated_at)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (job_key) DO UPDATE SET
+            bitmap = EXCLUDED.bitmap,
+            updated_at = EXCLUDED.updated_at
+    """, (ledger['job_key'], psycopg2.Binary(bytes(ledger['bitmap'])), time.time()))
+    conn.commit()
+    cursor.close()
+    conn.close()
+    ledger['pending'] = 0
+    ledger['last_flush'] = time.time()
+
+def clear_sent_ledger(job_key):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM sent_ledger WHERE job_key = %s", (job_key,))
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+def is_item_sent(ledger, index):
+    if ledger is None:
+        return False
+    bitmap = ledger['bitmap']
+    byte_index = index >> 3
+    return byte_index < len(bitmap) and bool(bitmap[byte_index] & (1 << (index & 7)))
+
+def mark_item_sent(ledger, index):
+    if ledger is None:
+        return
+    bitmap = ledger['bitmap']
+    byte_index = index >> 3
+    if byte_index >= len(bitmap):
+        bitmap.extend(bytes(byte_index + 1 - len(bitmap)))
+    bitmap[byte_index] |= 1 << (index & 7)
+    ledger['pending'] += 1
+    if ledger['pending'] >= LEDGER_FLUSH_EVERY or time.time() - ledger['last_flush'] >= LEDGER_FLUSH_SECONDS:
+        save_sent_ledger(ledger)
+
 async def pause_with_countdown(duration_seconds=120):
     sending_state = load_sending_state()
     sending_state['is_paused'] = True
@@ -123,126 +206,153 @@ async def pause_with_countdown(duration_seconds=120):
     sending_state['pause_countdown'] = 0
     save_sending_state(sending_state)
 
-async def send_column_data(client, entity, data_series, col_name, delay=0):
+def iter_text_lines(text):
+    # Scans the str or UTF-8 bytes in place, yielding each stripped non-empty line as str.splitlines() would split it
+    line_breaks = LINE_BREAKS_UTF8 if isinstance(text, bytes) else LINE_BREAKS
+    start = 0
+    while True:
+        match = line_breaks.search(text, start)
+        end = match.start() if match else len(text)
+        line = text[start:end]
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if line:
+            yield line
+        if match is None:
+            return
+        start = match.end()
+
+async def send_line_data(client, entity, lines, total, delay=0, ledger=None, offset=0):
     sending_state = load_sending_state()
-    for i, value in enumerate(data_series, 1):
+    for i, line in enumerate(lines, 1):
         if sending_state['should_stop']:
-            logger.info("Stop signal received, halting column sending.")
-            return
+            logger.info("Stop signal received, halting sending.")
+            return False
         sending_state['current_message'] = i
-        sending_state['total_messages'] = len(data_series)
-        if pd.isna(value):
+        sending_state['total_messages'] = total
+        if not line or is_item_sent(ledger, offset + i - 1):
             continue
-        value_str = str(int(float(value))) if isinstance(value, (float, int)) and float(value) == int(float(value)) else str(value).strip()
-        if value_str:
-            sending_state['current_number'] = value_str
+        sending_state['current_number'] = line
+        try:
+            await client.send_message(entity, line)
+            mark_item_sent(ledger, offset + i - 1)
+            sending_state['messages_sent_successfully'] += 1
+            sending_state['last_message_sent'] = line
+            if sending_state['messages_sent_successfully'] % 100 == 0:
+                await pause_with_countdown(120)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        except FloodWaitError as e:
+            await asyncio.sleep(e.seconds + 1)
             try:
-                await client.send_message(entity, value_str)
+                await client.send_message(entity, line)
+                mark_item_sent(ledger, offset + i - 1)
                 sending_state['messages_sent_successfully'] += 1
-                sending_state['last_message_sent'] = value_str
+                sending_state['last_message_sent'] = line
                 if sending_state['messages_sent_successfully'] % 100 == 0:
                     await pause_with_countdown(120)
-                if delay > 0:
-                    await asyncio.sleep(delay)
-            except FloodWaitError as e:
-                await asyncio.sleep(e.seconds + 1)
-                try:
-                    await client.send_message(entity, value_str)
-                    sending_state['messages_sent_successfully'] += 1
-                    sending_state['last_message_sent'] = value_str
-                    if sending_state['messages_sent_successfully'] % 100 == 0:
-                        await pause_with_countdown(120)
-                except Exception as retry_e:
-                    sending_state['messages_failed'] += 1
-                    logger.error(f"Failed to send item {i} '{value_str}' after rate limit wait: {retry_e}")
-            except Exception as e:
+            except Exception as retry_e:
                 sending_state['messages_failed'] += 1
-                logger.error(f"Failed to send item {i} '{value_str}': {e}")
+                logger.error(f"Failed to send item {i} '{line}' after rate limit wait: {retry_e}")
+        except Exception as e:
+            sending_state['messages_failed'] += 1
+            logger.error(f"Failed to send item {i} '{line}': {e}")
         save_sending_state(sending_state)
+    return True
 
-async def send_row_data(client, entity, df, delay=0):
-    sending_state = load_sending_state()
-    total_rows = len(df)
-    for i, (index, row) in enumerate(df.iterrows(), 1):
-        if sending_state['should_stop']:
-            logger.info("Stop signal received, halting row sending.")
-            return
-        sending_state['current_message'] = i
-        sending_state['total_messages'] = total_rows
+def format_cell_value(value):
+    import pandas as pd
+    if pd.isna(value):
+        return ''
+    return str(int(float(value))) if isinstance(value, (float, int)) and float(value) == int(float(value)) else str(value).strip()
+
+def render_column_messages(df):
+    # One segment per column; empty cells render as '' so indices stay aligned with the sent-item ledger
+    messages = []
+    for column in df.columns:
+        messages.extend(format_cell_value(value) for value in df[column])
+    return messages, max(len(df), 1)
+
+def render_row_messages(df):
+    messages = []
+    for index, row in df.iterrows():
         row_parts = []
         for col_name, value in row.items():
-            if pd.isna(value):
-                continue
-            value_str = str(int(float(value))) if isinstance(value, (float, int)) and float(value) == int(float(value)) else str(value).strip()
+            value_str = format_cell_value(value)
             if value_str:
                 if len(df.columns) == 1:
                     row_parts.append(value_str)
                 else:
                     row_parts.append(f"{col_name}: {value_str}")
-        if row_parts:
-            message = " | ".join(row_parts)
-            sending_state['current_number'] = message
-            try:
-                await client.send_message(entity, message)
-                sending_state['messages_sent_successfully'] += 1
-                sending_state['last_message_sent'] = message
-                if sending_state['messages_sent_successfully'] % 100 == 0:
-                    await pause_with_countdown(120)
-                if delay > 0:
-                    await asyncio.sleep(delay)
-            except FloodWaitError as e:
-                await asyncio.sleep(e.seconds + 1)
-                try:
-                    await client.send_message(entity, message)
-                    sending_state['messages_sent_successfully'] += 1
-                    sending_state['last_message_sent'] = message
-                    if sending_state['messages_sent_successfully'] % 100 == 0:
-                        await pause_with_countdown(120)
-                except Exception as retry_e:
-                    sending_state['messages_failed'] += 1
-                    logger.error(f"Failed to send row {i} '{message}' after rate limit wait: {retry_e}")
-            except Exception as e:
-                sending_state['messages_failed'] += 1
-                logger.error(f"Failed to send row {i} '{message}': {e}")
-        save_sending_state(sending_state)
+        messages.append(" | ".join(row_parts))
+    return messages, max(len(messages), 1)
+
+async def send_rendered_messages(client, entity, messages, segment, delay=0, ledger=None):
+    for offset in range(0, len(messages), segment):
+        batch = (messages[j] for j in range(offset, min(offset + segment, len(messages))))
+        if not await send_line_data(client, entity, batch, segment, delay=delay, ledger=ledger, offset=offset):
+            return False
+    return True
 
 async def send_messages(file_payload, manual_data, recipient, send_mode, session_string):
     API_ID = int(os.environ.get('TELEGRAM_API_ID', 0))
     API_HASH = os.environ.get('TELEGRAM_API_HASH', '')
     client = TelegramClient(StringSession(session_string), API_ID, API_HASH)
     sending_state = load_sending_state()
+    ledger = None
+    finished = False
     try:
         await client.connect()
         if not await client.is_user_authorized():
             logger.error("Not authorized in worker session")
             return
         entity = await client.get_entity(recipient)
-        if file_payload:
-            file_ext = file_payload['filename'].lower().rsplit('.', 1)[-1]
-            file_data = BytesIO(file_payload['data'])
-            if file_ext == 'xlsx':
-                df = pd.read_excel(file_data, engine='openpyxl')
-            elif file_ext == 'csv':
-                df = pd.read_csv(file_data)
-            elif file_ext == 'txt':
-                text = file_data.getvalue().decode('utf-8').strip()
-                lines = [line.strip() for line in text.splitlines() if line.strip()]
-                df = pd.DataFrame(lines, columns=['data'])
-            else:
-                logger.error("Unsupported file type")
-                return
-            if send_mode == 'rows':
-                await send_row_data(client, entity, df)
+        file_ext = file_payload['filename'].lower().rsplit('.', 1)[-1] if file_payload else None
+        if file_payload and file_ext not in ('txt', 'xlsx', 'csv'):
+            logger.error("Unsupported file type")
+            return
+        ledger = load_sent_ledger(compute_job_key(file_payload, manual_data, recipient, send_mode))
+        if file_ext == 'txt' or (not file_payload and manual_data):
+            # Plain lines need no parsing or coercion, so stream them without pandas
+            # The counting pass also decodes every line, so bad UTF-8 fails before anything is sent
+            text = file_payload['data'] if file_payload else manual_data
+            total = sum(1 for _ in iter_text_lines(text))
+            await send_line_data(client, entity, iter_text_lines(text), total, ledger=ledger)
+        elif file_payload:
+            # Repeat sends of the same upload reuse the rendered batch instead of re-parsing it
+            cache_key = render_cache_key(file_payload['data'], file_ext, send_mode)
+            cached = load_rendered_messages(cache_key)
+            if cached is not None:
+                messages, segment = cached, cached.segment
             else:
-                for column in df.columns:
-                    if sending_state['should_stop']:
-                        break
-                    await send_column_data(client, entity, df[column], column)
-        elif manual_data:
-            lines = [line.strip() for line in manual_data.splitlines() if line.strip()]
-            df = pd.DataFrame(lines, columns=['data'])
-            await send_column_data(client, entity, df['data'], 'data')
+                import pandas as pd
+                file_data = BytesIO(file_payload['data'])
+                if file_ext == 'xlsx':
+                    df = pd.read_excel(file_data, engine='openpyxl')
+                else:
+                    df = pd.read_csv(file_data)
+                if send_mode == 'rows':
+                    messages, segment = render_row_messages(df)
+                else:
+                    messages, segment = render_column_messages(df)
+                store_rendered_messages(cache_key, messages, segment)
+            try:
+                await send_rendered_messages(client, entity, messages, segment, ledger=ledger)
+            finally:
+                if cached is not None:
+                    cached.close()
+        finished = True
     finally:
+        if ledger is not None:
+            # Completed or user-stopped jobs drop their ledger; only a crash keeps it so a retry resumes
+            try:
+                if finished:
+                    clear_sent_ledger(ledger['job_key'])
+                else:
+                    save_sent_ledger(ledger)
+            except Exception as e:
+                logger.error(f"Failed to update sent ledger {ledger['job_key']}: {e}")
         sending_state['is_sending'] = False
         sending_state['should_stop'] = False
         save_sending_state(sending_state)